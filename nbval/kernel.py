@@ -7,6 +7,7 @@ Authors: D. Cortes, O. Laslett, T. Kluyver, H. Fangohr, V.T. Fauske
 
 import os
 import logging
+from collections import deque
 from pprint import pformat
 
 try:
@@ -82,6 +83,8 @@ class RunningKernel(object):
         Stores the active kernel process and its manager.
         """
 
+        self.kernel_name = kernel_name
+        self.cwd = cwd
         self.km, self.kc = start_new_kernel(
             startup_timeout=startup_timeout,
             kernel_name=kernel_name,
@@ -89,6 +92,9 @@ class RunningKernel(object):
             cwd=cwd,
         )
 
+        # Messages already received, but not yet handed out by get_message()
+        self._pending = {'iopub': deque(), 'shell': deque()}
+
         self._ensure_iopub_up()
 
     def _ensure_iopub_up(self):
@@ -119,17 +125,29 @@ class RunningKernel(object):
         Timeout is None by default
         When timeout is reached
         """
-        try:
-            if stream == 'iopub':
-                msg = self.kc.get_iopub_msg(timeout=timeout)
-            elif stream == 'shell':
-                msg = self.kc.get_shell_msg(timeout=timeout)
-            else:
-                raise ValueError('Invalid stream specified: "%s"' % stream)
-        except Empty:
-            logger.debug('Kernel: Timeout waiting for message on %s', stream)
-            raise
-        logger.debug("Kernel message (%s):\n%s", stream, pformat(msg))
+        if stream == 'iopub':
+            get_msg = self.kc.get_iopub_msg
+        elif stream == 'shell':
+            get_msg = self.kc.get_shell_msg
+        else:
+            raise ValueError('Invalid stream specified: "%s"' % stream)
+        pending = self._pending[stream]
+        if not pending:
+            try:
+                pending.append(get_msg(timeout=timeout))
+            except Empty:
+                logger.debug('Kernel: Timeout waiting for message on %s', stream)
+                raise
+            # Also take any messages that have already arrived, so that
+            # cells with lots of output don't need a blocking call each
+            while True:
+                try:
+                    pending.append(get_msg(timeout=0))
+                except Empty:
+                    break
+        msg = pending.popleft()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Kernel message (%s):\n%s", stream, pformat(msg))
         return msg
 
     def execute_cell_input(self, cell_input, allow_stdin=None):
@@ -155,7 +173,8 @@ class RunningKernel(object):
     def await_reply(self, msg_id, timeout=None):
         """
         Continuously poll the kernel 'shell' stream for messages until:
-         - It receives an 'execute_reply' status for the given message id
+         - It receives an 'execute_reply' status for the given message id,
+           which is returned
          - The timeout is reached awaiting a message, in which case
            a `Queue.Empty` exception will be raised.
         """
@@ -167,7 +186,7 @@ class RunningKernel(object):
                 if msg['content']['status'] == 'aborted':
                     # This should not occur!
                     raise RuntimeError('Kernel aborted execution request')
-                return
+                return msg
 
     def await_idle(self, parent_id, timeout):
         """Poll the iopub stream until an idle message is received for the given parent ID"""
@@ -194,6 +213,24 @@ class RunningKernel(object):
         """
         logger.debug('Restarting kernel')
         self.km.restart_kernel(now=True)
+        for pending in self._pending.values():
+            pending.clear()
+
+    def reset(self, timeout=60):
+        """
+        Clears the user namespace of an IPython kernel, so that it can
+        be reused for another notebook. Imported modules and other
+        process state are kept.
+
+        Raises a `RuntimeError` if the kernel could not reset, e.g. as
+        it does not understand IPython magics.
+        """
+        logger.debug('Resetting kernel')
+        msg_id = self.execute_cell_input('%reset -f', allow_stdin=False)
+        reply = self.await_reply(msg_id, timeout=timeout)
+        self.await_idle(msg_id, timeout)
+        if reply['content']['status'] != 'ok':
+            raise RuntimeError('Kernel failed to reset: %s' % reply['content'].get('ename'))
 
     def interrupt(self):
         """
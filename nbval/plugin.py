@@ -9,6 +9,7 @@ from __future__ import print_function
 
 # import the pytest API
 import pytest
+import ast
 import sys
 import os
 import re
@@ -17,17 +18,22 @@ import warnings
 from collections import OrderedDict, defaultdict
 from pathlib import Path
 from io import StringIO
-import pandas as pd
+from html import unescape
 
 from queue import Empty
 
 # for reading notebook files
 import nbformat
 from nbformat import NotebookNode
+import json
+try:
+    # Parses large notebooks (e.g. with many images) much faster
+    import orjson
+except ImportError:
+    orjson = None
 
 # Kernel for running notebooks
 from .kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME
-from .cover import setup_coverage, teardown_coverage
 
 
 # define colours for pretty outputs
@@ -115,6 +121,18 @@ def pytest_addoption(parser):
                     type=float,
                     help='Timeout for kernel startup, in seconds.')
 
+    group.addoption('--nbval-strict-df', action='store_true',
+                    help='Read dataframe outputs with pandas.read_html for '
+                         'nbval-test-df cells, rather than only scanning the '
+                         'structure of the HTML table')
+
+    group.addoption('--nbval-reuse-kernel', action='store_true',
+                    help='Reuse a running python kernel for all notebooks '
+                         'using the same kernel in the same directory, '
+                         'instead of starting a new kernel per notebook. '
+                         'The user namespace is reset between notebooks, '
+                         'but imported modules are kept.')
+
     group.addoption('--sanitize-with',
                     help='(deprecated) Alias of --nbval-sanitize-with')
 
@@ -132,6 +150,8 @@ def pytest_configure(config):
         from .nbdime_reporter import NbdimeReporter
         reporter = NbdimeReporter(config, sys.stdout)
         config.pluginmanager.register(reporter, 'nbdimereporter')
+    if config.option.nbval_reuse_kernel:
+        config.pluginmanager.register(KernelPool(), 'nbvalkernelpool')
     if config.option.sanitize_with:
         warnings.warn("--sanitize-with has been renamed to --nbval-sanitize-with", DeprecationWarning)
         if config.option.nbval_sanitize_with:
@@ -145,6 +165,10 @@ def pytest_configure(config):
     if config.option.nbval or config.option.nbval_lax:
         if config.option.nbval_kernel_name and config.option.current_env:
             raise ValueError("--current-env and --nbval-kernel-name are mutually exclusive.")
+        # All cells of a notebook run in the same kernel, so pytest-xdist must
+        # not hand them out to different workers
+        if getattr(config.option, 'dist', None) == 'load':
+            config.option.dist = 'loadfile'
 
 
 
@@ -178,12 +202,37 @@ def pytest_collect_file(path, parent):
 # folium-map
 # sk-container
 
+# Structural tests of the data of outputs, rather than comparing it, in order
+# of precedence: (check, tags, IPyNbCell comparator)
+data_comparators = (
+    ('figure', ('nbval-figure',), 'compare_figure_size'),
+    ('df', ('nbval-test-df',), 'compare_dataframes'),
+    ('list', ('nbval-test-listlen', 'nbval-test-tuple'), 'compare_list_len'),
+    ('list_members', ('nbval-list-membership',), 'compare_list_membership'),
+    ('set_members', ('nbval-set-membership',), 'compare_set_membership'),
+    ('dict', ('nbval-test-dictkeys',), 'compare_dict_keys'),
+    ('folium', ('folium-map',), 'check_folium_map'),
+    ('series', ('nbval-test-series',), 'compare_series'),
+)
+
+# Output keys which sanitize_outputs leaves as they are
+default_skip_sanitize = frozenset((
+    'metadata',
+    'traceback',
+    'text/latex',
+    'prompt_number',
+    'output_type',
+    'name',
+    'execution_count',
+))
+
+# Marker -> (option, value)
 comment_markers = {
     'PYTEST_VALIDATE_IGNORE_OUTPUT': ('check', False),  # For backwards compatibility
     'NBVAL_IGNORE_OUTPUT': ('check', False),
-    'NBVAL_CHECK_OUTPUT': 'check',
-    'NBVAL_RAISES_EXCEPTION': 'check_exception',
-    'NBVAL_SKIP': 'skip',
+    'NBVAL_CHECK_OUTPUT': ('check', True),
+    'NBVAL_RAISES_EXCEPTION': ('check_exception', True),
+    'NBVAL_SKIP': ('skip', True),
     'NBVAL_VARIABLE_OUTPUT': ('check', False),
     'SK-CONTAINER': ('check', False),
 }
@@ -193,7 +242,16 @@ metadata_tags = {
     for (k, v) in comment_markers.items()
 }
 
-metadata_tags['raises-exception'] = 'check_exception'
+metadata_tags['raises-exception'] = ('check_exception', True)
+
+# Every comment marker starts with one of these, e.g. "NBVAL"
+_comment_marker_prefixes = tuple(sorted({k.split('_')[0] for k in comment_markers}))
+
+# Matches a line holding only a comment marker, e.g. "# NBVAL_SKIP", in
+# source whose lines are separated by \n only
+_comment_marker_pat = re.compile(
+    r'^[^\S\n]*#+[^\S\n]*(%s)[^\S\n]*$' % '|'.join(map(re.escape, comment_markers)),
+    re.MULTILINE)
 
 
 def find_comment_markers(cellsource):
@@ -201,27 +259,25 @@ def find_comment_markers(cellsource):
 
     Yield an iterable of ``(MARKER_TYPE, True)``.
     """
+    if '#' not in cellsource or not any(
+            prefix in cellsource for prefix in _comment_marker_prefixes):
+        # No comments, or no markers in them
+        return
+    # Split lines on the same boundaries as str.splitlines, such as \r and
+    # \x0c, so that only \n ends a line and other whitespace is within one
+    cellsource = '\n'.join(cellsource.splitlines())
     found = {}
-    for line in cellsource.splitlines():
-        line = line.strip()
-        if line.startswith('#'):
-            # print("Found comment in '{}'".format(line))
-            comment = line.lstrip('#').strip()
-            if comment in comment_markers:
-                # print("Found marker {}".format(comment))
-                marker = comment_markers[comment]
-                if not isinstance(marker, tuple):
-                    # If not an explicit tuple ('option', True/False),
-                    # imply ('option', True)
-                    marker = (marker, True)
-                marker_type = marker[0]
-                if marker_type in found:
-                    warnings.warn(
-                        "Conflicting comment markers found, using the latest: "
-                        " %s VS %s" %
-                        (found[marker_type], comment))
-                found[marker_type] = comment
-                yield marker
+    for match in _comment_marker_pat.finditer(cellsource):
+        comment = match.group(1)
+        marker = comment_markers[comment]
+        marker_type = marker[0]
+        if marker_type in found:
+            warnings.warn(
+                "Conflicting comment markers found, using the latest: "
+                " %s VS %s" %
+                (found[marker_type], comment))
+        found[marker_type] = comment
+        yield marker
 
 
 def find_metadata_tags(cell_metadata):
@@ -235,10 +291,6 @@ def find_metadata_tags(cell_metadata):
     for tag in tags:
         if tag in metadata_tags:
             marker = metadata_tags[tag]
-            if not isinstance(marker, tuple):
-                # If not an explicit tuple ('option', True/False),
-                # imply ('option', True)
-                marker = (marker, True)
             marker_type = marker[0]
             if marker_type in found:
                 warnings.warn(
@@ -249,6 +301,58 @@ def find_metadata_tags(cell_metadata):
             yield marker
 
 
+def read_notebook(path):
+    """Read a notebook file as an nbformat v4 NotebookNode.
+
+    This is a faster alternative to ``nbformat.read(path, as_version=4)``:
+    v4 notebooks are parsed directly (with orjson, if it is installed), and
+    are not validated against the notebook schema. Older formats are read
+    by nbformat, so that they are converted.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        nb = orjson.loads(data) if orjson is not None else json.loads(data)
+    except ValueError:
+        # orjson rejects NaN and Infinity, which nbformat writes for such
+        # float values in outputs
+        nb = json.loads(data)
+    if nb.get('nbformat') != 4:
+        return nbformat.reads(data.decode('utf-8'), as_version=4)
+    return nbformat.v4.to_notebook_json(nb)
+
+
+class KernelPool:
+    """Keeps kernels running between notebooks, for --nbval-reuse-kernel"""
+    def __init__(self):
+        self.kernels = {}
+
+    def acquire(self, kernel_name, cwd, startup_timeout=60):
+        """Get an idle kernel with a clean namespace, starting one if needed"""
+        kernel = self.kernels.pop((kernel_name, cwd), None)
+        if kernel is not None and kernel.is_alive():
+            try:
+                kernel.reset()
+                return kernel
+            except (Empty, RuntimeError):
+                kernel.stop()
+        return RunningKernel(kernel_name, cwd=cwd, startup_timeout=startup_timeout)
+
+    def release(self, kernel):
+        """Return a kernel to the pool once a notebook is done with it"""
+        if kernel.language == 'python':
+            self.kernels[(kernel.kernel_name, kernel.cwd)] = kernel
+        else:
+            # We only know how to reset IPython kernels
+            kernel.stop()
+
+    def pytest_sessionfinish(self):
+        for kernel in self.kernels.values():
+            if kernel.is_alive():
+                kernel.stop()
+        self.kernels.clear()
+
+
 class Dummy:
     """Needed to use xfail for our tests"""
     def __init__(self):
@@ -265,7 +369,12 @@ class IPyNbFile(pytest.File):
     def __init__(self, *args, **kwargs):
         super(IPyNbFile, self).__init__(*args, **kwargs)
         config = self.parent.config
-        self.sanitize_patterns = OrderedDict()  # Filled in setup_sanitize_patterns()
+        # Maps regex -> (compiled regex, replace); filled in setup()
+        self.sanitize_patterns = OrderedDict()
+        # The passes sanitize() makes, built from sanitize_patterns in setup()
+        self.sanitize_passes = []
+        # Report markers sanitize() removes, as enabled by the options
+        self.sanitize_markers = ()
         self.compare_outputs = not config.option.nbval_lax
         self.timed_out = False
         self.skip_compare = (
@@ -288,48 +397,50 @@ class IPyNbFile(pytest.File):
         Called by pytest to setup the collector cells in .
         Here we start a kernel and setup the sanitize patterns.
         """
+        opt = self.parent.config.option
         # we've already checked that --nbval-current-env and
         # --nbval-kernel-name were not both supplied
-        if self.parent.config.option.nbval_current_env:
+        if opt.nbval_current_env:
             kernel_name = CURRENT_ENV_KERNEL_NAME
-        elif self.parent.config.option.nbval_kernel_name:
-            kernel_name = self.parent.config.option.nbval_kernel_name
+        elif opt.nbval_kernel_name:
+            kernel_name = opt.nbval_kernel_name
         else:
             kernel_name = self.nb.metadata.get(
                 'kernelspec', {}).get('name', 'python')
-        self.kernel = RunningKernel(
-            kernel_name,
-            cwd=str(self.fspath.dirname),
-            startup_timeout=self.config.option.nbval_kernel_startup_timeout, 
-        )
+        pool = self.config.pluginmanager.getplugin('nbvalkernelpool')
+        if pool is not None:
+            self.kernel = pool.acquire(
+                kernel_name,
+                cwd=str(self.fspath.dirname),
+                startup_timeout=opt.nbval_kernel_startup_timeout,
+            )
+        else:
+            self.kernel = RunningKernel(
+                kernel_name,
+                cwd=str(self.fspath.dirname),
+                startup_timeout=opt.nbval_kernel_startup_timeout,
+            )
 
         self.setup_sanitize_files()
-        if self.parent.config.option.nbval_ignore_core_sanitisation:
+        if opt.nbval_ignore_core_sanitisation:
             self.core_sanitizer()
-        if self.parent.config.option.nbval_test_timeit:
+        if opt.nbval_test_timeit:
             self.timeit_sanitiser()
-        #if self.parent.config.option.nbval_test_memit:
+        #if opt.nbval_test_memit:
         #    self.memit_sanitiser()
-
-        if getattr(self.parent.config.option, 'cov_source', None):
+        self.sanitize_passes = list(self.sanitize_patterns.values())
+        self.sanitize_markers = tuple(
+            marker for marker, enabled in (("TIMEIT-REPORT", opt.nbval_skip_timeit),
+                                           ("MEMIT-REPORT", opt.nbval_skip_memit))
+            if enabled)
+
+        if getattr(opt, 'cov_source', None):
+            from .cover import setup_coverage
             setup_coverage(self.parent.config, self.kernel, getattr(self, "fspath", None))
 
     def timeit_sanitiser(self):
         """Sanitise %%time and %%timeit outputs."""
-        timeit_regex="""[regex1]
-[regext1]
-regex: CPU times: .*
-replace: CPU times: CPUTIME
-
-[regext2]
-regex: Wall time: .*
-replace: Wall time: WALLTIME
-
-[regext3]
-regex: .* per loop \(mean ± std. dev. of .* runs, .* loops each\)
-replace: TIMEIT-REPORT
-"""
-        self.sanitize_patterns.update(get_sanitize_patterns(timeit_regex)) 
+        self.sanitize_patterns.update(_timeit_sanitize_patterns)
 
     # The following core sanitisation in part relates to handling timeit strings
     # However, it might be more useful to be able to compare times
@@ -337,69 +448,20 @@ replace: TIMEIT-REPORT
     # or more out, but not if the times are about the same?
     def core_sanitizer(self):
         """Define a core set of sanitisation expressions."""
-        core_regex="""
-[regex1]
-regex: <graphviz.sources.Source at 0x[a-f0-9]*>
-replace: <graphviz.sources.Source>
-
-[regex2]
-regex: ^.* per loop .mean ± std. dev. of [0-9]+ runs, [0-9]+ loop each.
-replace: TIMEIT-REPORT
-
-[regex3]
-regex: peak memory: .* MiB, increment: .* MiB
-replace: MEMIT-REPORT
-
-[regex4]
-regex: <seaborn\..* at 0x[a-f0-9]*>
-replace: SEABORN-ID
-
-[regex5]
-regex: <pandas.core.groupby.generic.DataFrameGroupBy object at 0x[a-f0-9]*>
-replace: PANDAS_GROUP_BY
-
-[regex6]
-regex: <pymongo.results.InsertOneResult at 0x[a-f0-9]*>
-replace: MONGO_INSERT_ONE
-
-[regex7]
-regex: <pymongo.results.InsertManyResult at 0x[a-f0-9]*>
-replace: MONGO_INSERT_MANY
-
-[regex8]
-regex: <pymongo.cursor.Cursor at 0x[a-f0-9]*>
-replace: MONGO_CURSOR
-
-[regex9]
-regex: <pymongo.results.UpdateResult at 0x[a-f0-9]*>
-replace: MONGO_UPDATE
-
-[regex10]
-regex: <map at 0x[a-f0-9]*>
-replace: PYTHON_MAP
-
-[regex11]
-regex: <Graph identifier=.*>
-replace: RDF_GRAPH
-
-[regex12]
-regex: \s+[\n\r]+
-replace: \n
-
-[regex13]
-regex: ObjectId\('[a-f0-9]*'\)
-replace: ObjectId_
-"""
-        self.sanitize_patterns.update(get_sanitize_patterns(core_regex))  
+        self.sanitize_patterns.update(_core_sanitize_patterns)
 
     def setup_sanitize_files(self):
         """
         For each of the sanitize files that were specified as command line options
         load the contents of the file into the sanitise patterns dictionary.
         """
+        loaded = self.config.stash.setdefault(_sanitize_files_key, {})
         for fname in self.get_sanitize_files():
-            with open(fname, 'r') as f:
-                self.sanitize_patterns.update(get_sanitize_patterns(f.read()))
+            if fname not in loaded:
+                with open(fname, 'r') as f:
+                    loaded[fname] = compile_sanitize_patterns(
+                        get_sanitize_patterns(f.read()))
+            self.sanitize_patterns.update(loaded[fname])
 
 
     def get_sanitize_files(self):
@@ -429,10 +491,22 @@ replace: ObjectId_
         Item objects. We specify an Item for each code cell in the notebook.
         """
 
-        self.nb = nbformat.read(str(self.fspath), as_version=4)
+        self.nb = read_notebook(str(self.fspath))
         if "nbval_nb_ignore" in self.nb["metadata"] and self.nb["metadata"]["nbval_nb_ignore"]:
             return
 
+        opt = self.parent.config.option
+        skip_timeit = opt.nbval_skip_timeit
+        skip_memit = opt.nbval_skip_memit
+
+        # Cells starting with these magics are skipped altogether
+        # ("%%time" also covers "%%timeit")
+        skip_cell_magics = ()
+        if skip_timeit:
+            skip_cell_magics += ("%%time",)
+        if skip_memit:
+            skip_cell_magics += ("%%memit",)
+
         # Start the cell count
         cell_num = 1
 
@@ -444,15 +518,22 @@ replace: ObjectId_
                 # The cell may contain a comment indicating that its output
                 # should be checked or ignored. If it doesn't, use the default
                 # behaviour. The --nbval option checks unmarked cells.
-                with warnings.catch_warnings(record=True) as ws:
-                    options = defaultdict(bool, find_metadata_tags(cell.metadata))
-                    comment_opts = dict(find_comment_markers(cell.source))
+                options = defaultdict(bool)
+                comment_opts = {}
+                ws = []
+                # Only cells with tags or comments can have markers (or warnings
+                # about them), so spare all other cells the catch_warnings() setup
+                if 'tags' in cell.metadata or '#' in cell.source:
+                    with warnings.catch_warnings(record=True) as ws:
+                        options.update(find_metadata_tags(cell.metadata))
+                        comment_opts.update(find_comment_markers(cell.source))
                 loc = '%s:Code cell %d' % (getattr(self, "fspath", None), cell_num)
-                if set(comment_opts.keys()) & set(options.keys()):
+                overlapping = comment_opts.keys() & options.keys()
+                if overlapping:
                     warnings.warn_explicit(
                         "Overlapping options from comments and metadata, "
                         "using options from comments: %s" %
-                        str(set(comment_opts.keys()) & set(options.keys())),
+                        str(overlapping),
                         category=UserWarning,
                         filename=loc,
                         lineno=0
@@ -470,13 +551,8 @@ replace: ObjectId_
                 # Also need to handle last line %timeit
                 # We need a chomper or code parser to drop commented lines at end of cell...
                 # This could be # prefixed lines or triple quoted lines
-                if self.parent.config.option.nbval_skip_timeit:
-                    if cell.source.startswith("%%time"):
-                        options.update({"skip": True})
-
-                if self.parent.config.option.nbval_skip_memit:
-                    if cell.source.startswith("%%memit"):
-                        options.update({"skip": True})
+                if skip_cell_magics and cell.source.startswith(skip_cell_magics):
+                    options.update({"skip": True})
 
                 # If line is timeit or memit magic,
                 # we might want to skip the memit/timeit operation
@@ -485,16 +561,22 @@ replace: ObjectId_
                 # What if the function is actually doing something useful?
                 # What if timeit is over sveral lines?
                 # The nbval-run-all means we don't mask running the memit/timeit
-                if "nbval-run-all" not in cell.metadata.get('tags', []) and (self.parent.config.option.nbval_skip_timeit or self.parent.config.option.nbval_skip_memit):
-                    cell_lines = [c for c in cell.source.split("\n") if c.strip()]
-                    for ci, cl in enumerate(cell_lines):
-                        if self.parent.config.option.nbval_skip_timeit:
-                            if cl.lstrip().startswith("%timeit "):
-                                cell_lines[ci] = cl.replace("%timeit ", "print("")#%timeit")
-                        if self.parent.config.option.nbval_skip_memit:
-                            if cl.lstrip().startswith("%memit "):
-                                cell_lines[ci] = cl.replace("%memit ", "print("")#%memit ")
-                    cell.source = "\n".join(cell_lines)
+                # Only cells that actually use the magics are rewritten
+                if (skip_timeit or skip_memit) and "%" in cell.source:
+                    mask_timeit = skip_timeit and "%timeit " in cell.source
+                    mask_memit = skip_memit and "%memit " in cell.source
+                    if (mask_timeit or mask_memit) and "nbval-run-all" not in cell.metadata.get('tags', []):
+                        cell_lines = []
+                        for cl in cell.source.split("\n"):
+                            stripped = cl.lstrip()
+                            if not stripped:
+                                continue
+                            if mask_timeit and stripped.startswith("%timeit "):
+                                cl = cl.replace("%timeit ", "print("")#%timeit")
+                            if mask_memit and stripped.startswith("%memit "):
+                                cl = cl.replace("%memit ", "print("")#%memit ")
+                            cell_lines.append(cl)
+                        cell.source = "\n".join(cell_lines)
 
                 # If we have an output suppressor (;) at end of last line
                 # append a pass instruction to the cell to mock the behaviour
@@ -517,8 +599,13 @@ replace: ObjectId_
     def teardown(self):
         if self.kernel is not None and self.kernel.is_alive():
             if getattr(self.parent.config.option, 'cov_source', None):
+                from .cover import teardown_coverage
                 teardown_coverage(self.parent.config, self.kernel)
-            self.kernel.stop()
+            pool = self.config.pluginmanager.getplugin('nbvalkernelpool')
+            if pool is not None and not self.timed_out:
+                pool.release(self.kernel)
+            else:
+                self.kernel.stop()
 
 
 class IPyNbCell(pytest.Item):
@@ -530,8 +617,18 @@ class IPyNbCell(pytest.Item):
         self.parent = parent
         self.cell_num = cell_num
         self.cell = cell
-        self.tags = cell.metadata.get('tags', [])
+        tags = cell.metadata.get('tags', [])
+        # Tags are looked up for every output, and non-list tags are ignored
+        # (see find_metadata_tags)
+        self.tags = frozenset(tags) if isinstance(tags, list) else frozenset()
+        # The structural tests that apply to the data of outputs
+        self.data_comparators = [
+            (check, getattr(self, comparator))
+            for check, tags, comparator in data_comparators
+            if not self.tags.isdisjoint(tags)]
         self.test_outputs = None
+        # The coalesced reference outputs, see runtest
+        self._ref_outputs = None
         self.options = options
         self.config = parent.parent.config
         self.output_timeout = 5
@@ -585,14 +682,19 @@ class IPyNbCell(pytest.Item):
         df_test = False
         test_out = ()
         if "nbval-test-df" in self.tags and key in item and data_key in item[key]:
-            df = pd.read_html(StringIO(item[key][data_key]))[0]
+            if self.config.option.nbval_strict_df:
+                import pandas as pd
+                df = pd.read_html(StringIO(item[key][data_key]))[0]
+                test_out = (df.shape, df.columns.tolist())
+            else:
+                test_out = html_table_shape(item[key][data_key])
             df_test = True
-            test_out = (df.shape, df.columns.tolist())
         return df_test, data_key, test_out
 
     def compare_series(self, item, key="data", data_key="text/html"):
         """Test outputs for series comparison."""
         def make_series(txt):
+            import pandas as pd
             # Split the data string by lines
             lines = txt.strip("\n").split("\n")[:-1]
             index = []
@@ -630,7 +732,8 @@ class IPyNbCell(pytest.Item):
     def _clean_mongo_hack(self, txt):
         """Hack to cope with mongo elements."""
         _tmp = txt if not isinstance(txt, list) else "".join(txt)
-        _tmp = _tmp.replace("ObjectId", "str").replace("nan", "None") if isinstance(_tmp, str) else _tmp
+        # ObjectId('...') -> '...', so that the string can be parsed as a literal
+        _tmp = _objectid_pat.sub(r"\1", _tmp).replace("nan", "None") if isinstance(_tmp, str) else _tmp
         return _tmp
 
     # The following also compares tuples
@@ -641,7 +744,7 @@ class IPyNbCell(pytest.Item):
         if any(x in self.tags for x in ["nbval-test-listlen", "nbval-test-tuple"]) and key in item and data_key in item[key]:
             try:
                 _tmp = self._clean_mongo_hack(item[key][data_key])
-                list_ = eval(_tmp)
+                list_ = _literal_eval(_tmp)
                 ltype = tuple if "nbval-test-tuple" in self.tags else list
                 if isinstance(list_, ltype):
                     list_len = len(list_)
@@ -657,7 +760,7 @@ class IPyNbCell(pytest.Item):
         if "nbval-list-membership" in self.tags and key in item and data_key in item[key]:
             try:
                 _tmp = self._clean_mongo_hack(item[key][data_key])
-                list_ = eval(_tmp)
+                list_ = _literal_eval(_tmp)
                 if isinstance(list_, list):
                     list_.sort()
                     list_members = list_
@@ -672,7 +775,7 @@ class IPyNbCell(pytest.Item):
         set_members = {}
         if "nbval-set-membership" in self.tags and key in item and data_key in item[key]:
             try:
-                set_ = eval(item[key][data_key])
+                set_ = ast.literal_eval(item[key][data_key])
                 if isinstance(set_, set):
                     set_members = set_
                 set_members_test = True
@@ -686,7 +789,7 @@ class IPyNbCell(pytest.Item):
         if "nbval-test-dictkeys" in self.tags and key in item and data_key in item[key]:
             try:
                 _tmp = self._clean_mongo_hack(item[key][data_key])
-                dict_ = eval(_tmp)
+                dict_ = _literal_eval(_tmp)
                 if isinstance(dict_, dict):
                     dict_keys = sorted(dict_.keys())
                 dict_test = True
@@ -711,15 +814,75 @@ class IPyNbCell(pytest.Item):
          
         return figure_test, figure_size
 
-    def compare_outputs(self, test, ref, skip_compare=None):
-        # Use stored skips unless passed a specific value
-        skip_compare = skip_compare or self.parent.skip_compare
+    def _flatten_outputs(self, outputs, skip_compare):
+        """Reformat outputs for comparison, as described in compare_outputs.
+
+        Also returns a dict saying which structural tests were applied, as
+        found for the last output they could apply to.
+        """
+        outs = defaultdict(list)
+        checks = {}
+        for output in outputs:
+            if output.output_type == 'stream':
+                # Makes failure output for streams better by having key be
+                # the stream name
+                output = {'output_type': 'stream', output.name: output.text}
+            for key, value in output.items():
+                # We discard the keys from the skip_compare list:
+                if key not in skip_compare:
+                    # Flatten out MIME types from data of display_data and execute_result
+                    if key == 'data':
+                        applied = False
+                        for check, comparator in self.data_comparators:
+                            test, *_, result = comparator(output, key)
+                            checks[check] = test
+                            # If we have passed a structural test, we don't want to capture any of the other fields?
+                            # Results are compared under the data key of compare_dataframes
+                            if test and not applied:
+                                applied = True
+                                # A figure without a size is left out of the comparison
+                                if check != 'figure' or result:
+                                    outs['text/html'].append(result)
+                        if not applied:
+                            self._flatten_data(value, skip_compare, outs)
+                    # Otherwise, just create a normal dictionary entry from
+                    # one of the keys of the dictionary
+                    else:
+                        # This might include things like key=='stdout' printed messages
+                        linecount_test, linecount = self.compare_print_lines(output)
+                        checks['linecount'] = linecount_test
+                        if linecount_test:
+                            outs[key].append(linecount)
+                        else:
+                            outs[key].append(self.sanitize(value))
+        return outs, checks
+
+    def _flatten_data(self, data, skip_compare, outs):
+        """Add the MIME types of an output's data to the flattened outputs"""
+        for data_key, value in data.items():
+            # Filter the keys in the SUB-dictionary again:
+            if data_key not in skip_compare:
+                if data_key in _base64_mime_types and type(value) is str:
+                    # Nothing to sanitize in base64 data, but
+                    # line breaks may differ
+                    value = ''.join(value.split())
+                else:
+                    value = self.sanitize(value)
+                outs[data_key].append(value)
 
-        test = transform_streams_for_comparison(test)
-        ref = transform_streams_for_comparison(ref)
+    def compare_outputs(self, test, ref, skip_compare=None):
+        # Use stored skips unless passed a specific value. They are kept as a
+        # tuple (conftest files may extend them with +=), but are looked up
+        # for every output key, so use a set here
+        skip_compare = frozenset(skip_compare or self.parent.skip_compare)
 
         # Color codes to use for reporting
         cc = self.colors
+        FAIL, OKBLUE, ENDC = cc.FAIL, cc.OKBLUE, cc.ENDC
+
+        # The traceback from the comparison will be stored here.
+        self.comparison_traceback = []
+        report = self.comparison_traceback.append
 
         # We reformat outputs into a dictionaries where
         # key:
@@ -731,235 +894,101 @@ class IPyNbCell(pytest.Item):
         # This format allows to disregard the relative order of dissimilar
         # output keys, while still caring about the order of those that share
         # a key.
-        testing_outs = defaultdict(list)
-        reference_outs = defaultdict(list)
-
-        # The traceback from the comparison will be stored here.
-        self.comparison_traceback = []
-
-        # Verbose diagnostic reporting
-        #self.comparison_traceback.append(f"OPTIONS: {self.options}")
-        #self.comparison_traceback.append(f"TAGS: {self.tags}")
-        #self.comparison_traceback.append(f"REFS: {ref}")
-        figure_test = False
-        df_test = False
-        list_test = False
-        list_members_test = False
-        set_members_test = False
-        dict_test = False
-        linecount_test = False
-        folium_test = False
-        series_test = False
-        for reference in ref:
-            for key in reference.keys():
-                # We discard the keys from the skip_compare list:
-                if key not in skip_compare:
-                    # Flatten out MIME types from data of display_data and execute_result
-                    if key == 'data':
-                        # Check if we have an image
-                        figure_test, figure_size = self.compare_figure_size(reference, key)
-                        # Check if a dataframe structural equivalence test is requested
-                        df_test, data_key, reference_df_test = self.compare_dataframes(reference, key)
-                        list_test, list_len = self.compare_list_len(reference, key)
-                        list_members_test, list_members = self.compare_list_membership(reference, key)
-                        set_members_test, set_members = self.compare_set_membership(reference, key)
-                        dict_test, dict_keys = self.compare_dict_keys(reference, key)
-                        folium_test, map_rendered = self.check_folium_map(reference, key)
-                        series_test, series_len = self.compare_series(reference, key)
-                        # If we have passed a structural test, we don't want to capture any of the other fields?
-                        if figure_test:
-                            if figure_size:
-                                reference_outs[data_key].append(figure_size)
-                        elif df_test:
-                            reference_outs[data_key].append(reference_df_test)
-                        elif list_test:
-                            reference_outs[data_key].append(list_len)
-                        elif list_members_test:
-                            reference_outs[data_key].append(list_members)
-                        elif set_members_test:
-                            reference_outs[data_key].append(set_members)
-                        elif dict_test:
-                            reference_outs[data_key].append(dict_keys)
-                        elif folium_test:
-                            reference_outs[data_key].append(map_rendered)
-                        elif series_test:
-                            reference_outs[data_key].append(series_len)         
-                        else:
-                            for data_key in reference[key].keys():
-                                # Filter the keys in the SUB-dictionary again:
-                                if data_key not in skip_compare:
-                                    reference_outs[data_key].append(self.sanitize(reference[key][data_key]))
-                    # Otherwise, just create a normal dictionary entry from
-                    # one of the keys of the dictionary
-                    else:
-                        # Create the dictionary entries on the fly, from the
-                        # existing ones to be compared
-                        # This might include things like key=='stdout' printed messages
-                        linecount_test, reference_linecount_test = self.compare_print_lines(reference)
-                        if linecount_test:
-                            reference_outs[key].append(reference_linecount_test)
-                        else:
-                            reference_outs[key].append(self.sanitize(reference[key]))
-
-
+        reference_outs, checks = self._flatten_outputs(ref, skip_compare)
         # the same for the testing outputs (the cells that are being executed)
-        # Verbose diagnostic reporting
-        #self.comparison_traceback.append(f"TEST: {test}")
-        for testing in test:
-            for key in testing.keys():
-                if key not in skip_compare:
-                    if key == 'data':
-                        # Check if we have an image
-                        figure_test, figure_size = self.compare_figure_size(testing, key)
-                        # Check if a dataframe structural equivalence test is requested
-                        df_test, data_key, testing_df_test = self.compare_dataframes(testing, key)
-                        list_test, list_len = self.compare_list_len(testing, key)
-                        list_members_test, list_members = self.compare_list_membership(testing, key)
-                        set_members_test, set_members = self.compare_set_membership(testing, key)
-                        dict_test, dict_keys = self.compare_dict_keys(testing, key)
-                        folium_test, map_rendered = self.check_folium_map(testing, key)
-                        series_test, series_len = self.compare_series(testing, key)
-                        if figure_test:
-                            if figure_size:
-                                testing_outs[data_key].append(figure_size)
-                        elif df_test:
-                            testing_outs[data_key].append(testing_df_test)
-                        elif list_test:
-                            testing_outs[data_key].append(list_len)
-                        elif list_members_test:
-                            testing_outs[data_key].append(list_members)
-                        elif set_members_test:
-                            testing_outs[data_key].append(set_members)
-                        elif dict_test:
-                            testing_outs[data_key].append(dict_keys)
-                        elif folium_test:
-                            testing_outs[data_key].append(map_rendered)
-                        elif series_test:
-                            testing_outs[data_key].append(series_len)
-                        else:
-                            for data_key in testing[key].keys():
-                                if data_key not in skip_compare:
-                                    testing_outs[data_key].append(self.sanitize(testing[key][data_key]))
-                    # Do we also need to compare the printlines output?
-                    # For example, some cells may have printed output
-                    # as well as object returned output
-                    else:
-                        # This might include things like key=='stdout' printed messages
-                        linecount_test, testing_linecount_test = self.compare_print_lines(testing)
-                        if linecount_test:
-                            testing_outs[key].append(testing_linecount_test)
-                        else:
-                            testing_outs[key].append(self.sanitize(testing[key]))
+        testing_outs, testing_checks = self._flatten_outputs(test, skip_compare)
+        checks.update(testing_checks)
+        figure_test = checks.get('figure', False)
+        df_test = checks.get('df', False)
+        list_test = checks.get('list', False)
+        list_members_test = checks.get('list_members', False)
+        set_members_test = checks.get('set_members', False)
+        dict_test = checks.get('dict', False)
+        linecount_test = checks.get('linecount', False)
+        folium_test = checks.get('folium', False)
+        series_test = checks.get('series', False)
 
         # Use this to force a return here and preview the initial traceback output
         #return False
 
-        ref_keys = set(reference_outs.keys())
-        test_keys = set(testing_outs.keys())
-
-        missing_output_fields = ref_keys - test_keys
-        unexpected_output_fields = test_keys - ref_keys
+        missing_output_fields = reference_outs.keys() - testing_outs.keys()
+        unexpected_output_fields = testing_outs.keys() - reference_outs.keys()
 
         if missing_output_fields:
-            self.comparison_traceback.append(
-                cc.FAIL
-                + "Missing output fields from running code: %s"
-                % (missing_output_fields)
-                + '\n'+'\n'.join([f"\t{k}: {reference_outs[k]}" for k in missing_output_fields])
-                + cc.ENDC
+            fields = '\n'.join([f"\t{k}: {reference_outs[k]}" for k in missing_output_fields])
+            report(
+                f"{FAIL}Missing output fields from running code: "
+                f"{missing_output_fields}\n{fields}{ENDC}"
             )
             return False
         elif unexpected_output_fields:
-            self.comparison_traceback.append(
-                cc.FAIL
-                + "Unexpected output fields from running code: %s"
-                % (unexpected_output_fields)
-                + '\n'+'\n'.join([f"\t{k}: {testing_outs[k]}" for k in unexpected_output_fields])
-                + cc.ENDC
+            fields = '\n'.join([f"\t{k}: {testing_outs[k]}" for k in unexpected_output_fields])
+            report(
+                f"{FAIL}Unexpected output fields from running code: "
+                f"{unexpected_output_fields}\n{fields}{ENDC}"
             )
             return False
 
         # If we've got to here, the two dicts must have the same set of keys
 
-        for key in reference_outs.keys():
+        for key, ref_values in reference_outs.items():
             # Get output values for dictionary entries.
-            # We use str() to be sure that the unicode key strings from the
-            # reference are also read from the testing dictionary:
-            test_values = testing_outs[str(key)]
-            ref_values = reference_outs[key]
+            test_values = testing_outs[key]
             if len(test_values) != len(ref_values):
                 # The number of outputs for a specific MIME type differs
-                self.comparison_traceback.append(
-                    cc.OKBLUE
-                    + 'dissimilar number of outputs for key "%s"' % key
-                    + cc.FAIL
-                    + "<<<<<<<<<<<< Reference outputs from ipynb file:"
-                    + cc.ENDC
+                report(
+                    f'{OKBLUE}dissimilar number of outputs for key "{key}"'
+                    f'{FAIL}<<<<<<<<<<<< Reference outputs from ipynb file:{ENDC}'
                 )
+                # Values from structural tests are not strings
                 for val in ref_values:
-                    self.comparison_traceback.append(_trim_base64(val))
-                self.comparison_traceback.append(
-                    cc.FAIL
-                    + '============ disagrees with newly computed (test) output:'
-                    + cc.ENDC)
+                    report(_trim_base64(val) if isinstance(val, str) else str(val))
+                report(
+                    f'{FAIL}============ disagrees with newly computed (test) output:{ENDC}')
                 for val in test_values:
-                    self.comparison_traceback.append(_trim_base64(val))
-                self.comparison_traceback.append(
-                    cc.FAIL
-                    + '>>>>>>>>>>>>'
-                    + cc.ENDC)
+                    report(_trim_base64(val) if isinstance(val, str) else str(val))
+                report(f'{FAIL}>>>>>>>>>>>>{ENDC}')
                 return False
 
+            # Compare all values at once, and only look for the
+            # mismatching one if there is one
+            if ref_values == test_values:
+                continue
+
             for ref_out, test_out in zip(ref_values, test_values):
                 # Compare the individual values
                 if ref_out != test_out:
                     if figure_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " figure mess up '%s'" % key
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} figure mess up '{key}'{FAIL}")
                     if df_test:
                         self.format_output_compare_df(key, ref_out, test_out)
                     if list_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " list length mismatch '%s'" % key
-                            + f": {ref_out} != {test_out}"
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} list length mismatch '{key}'"
+                            f": {ref_out} != {test_out}{FAIL}")
                     if list_members_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " list members mismatch '%s'" % key
-                            + f": {ref_out} != {test_out}"
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} list members mismatch '{key}'"
+                            f": {ref_out} != {test_out}{FAIL}")
                     if set_members_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " set members mismatch '%s'" % key
-                            + f": {ref_out} != {test_out}"
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} set members mismatch '{key}'"
+                            f": {ref_out} != {test_out}{FAIL}")
                     if dict_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " dict keys mismatch '%s'" % key
-                            + f": {ref_out} != {test_out}"
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} dict keys mismatch '{key}'"
+                            f": {ref_out} != {test_out}{FAIL}")
                     if linecount_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " linecount mismatch '%s'" % key
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} linecount mismatch '{key}'{FAIL}")
                     if folium_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " folium map not returned '%s'" % key
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} folium map not returned '{key}'{FAIL}")
                     if series_test:
-                        self.comparison_traceback.append(
-                            cc.OKBLUE
-                            + " Series length mismatch '%s'" % key
-                            + f": {ref_out} != {test_out}"
-                            + cc.FAIL)
+                        report(
+                            f"{OKBLUE} Series length mismatch '{key}'"
+                            f": {ref_out} != {test_out}{FAIL}")
                     if not df_test and not linecount_test and not list_test and not dict_test:
                         self.format_output_compare(key, ref_out, test_out)
                     return False
@@ -1129,15 +1158,14 @@ class IPyNbCell(pytest.Item):
 
 
 
+            # Is the iopub message related to this cell execution?
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue
+
             # now we must handle the message by checking the type and reply
             # info and we store the output of the cell in a notebook node object
             msg_type = msg['msg_type']
             reply = msg['content']
-            out = NotebookNode(output_type=msg_type)
-
-            # Is the iopub message related to this cell execution?
-            if msg['parent_header'].get('msg_id') != msg_id:
-                continue
 
             # When the kernel starts to execute code, it will enter the 'busy'
             # state and when it finishes, it will enter the 'idle' state.
@@ -1189,9 +1217,12 @@ class IPyNbCell(pytest.Item):
             # as height and width of the image (CHECK the documentation)
             # Thus we iterate through the keys (mimes) 'data' sub-dictionary
             # to obtain the 'text' and 'image/png' information
+            # Output nodes are built in one go, so their data is kept as
+            # received rather than converted to nested nodes key by key
             elif msg_type in ('display_data', 'execute_result'):
-                out['metadata'] = reply['metadata']
-                out['data'] = reply['data']
+                out = NotebookNode(output_type=msg_type,
+                                   metadata=reply['metadata'],
+                                   data=reply['data'])
                 outs.append(out)
 
                 if msg_type == 'execute_result':
@@ -1200,9 +1231,9 @@ class IPyNbCell(pytest.Item):
 
             # if the message is a stream then we store the output
             elif msg_type == 'stream':
-                out.name = reply['name']
-                out.text = reply['text']
-                outs.append(out)
+                outs.append(NotebookNode(output_type=msg_type,
+                                         name=reply['name'],
+                                         text=reply['text']))
 
 
             # if the message type is an error then an error has occurred during
@@ -1210,9 +1241,10 @@ class IPyNbCell(pytest.Item):
             # traceback information.
             elif msg_type == 'error':
                 # Store error in output first
-                out['ename'] = reply['ename']
-                out['evalue'] = reply['evalue']
-                out['traceback'] = reply['traceback']
+                out = NotebookNode(output_type=msg_type,
+                                   ename=reply['ename'],
+                                   evalue=reply['evalue'],
+                                   traceback=reply['traceback'])
                 outs.append(out)
                 if not self.options['check_exception']:
                     # Ensure we flush iopub before raising error
@@ -1233,10 +1265,15 @@ class IPyNbCell(pytest.Item):
             else:
                 print("unhandled iopub msg:", msg_type)
 
-        outs[:] = coalesce_streams(outs)
-
         # Cells where the reference is not run, will not check outputs:
         unrun = self.cell.execution_count is None
+        check = self.options['check'] and not unrun
+
+        # Coalescing is only needed to compare the outputs or to show
+        # them in the nbdime report, so lax cells can skip it.
+        if check or self.config.option.nbdime:
+            outs[:] = coalesce_streams(outs)
+
         if unrun and self.cell.outputs:
             self.raise_cell_error('Unrun reference cell has outputs')
 
@@ -1246,8 +1283,12 @@ class IPyNbCell(pytest.Item):
         #     self.diff_number_outputs(outs, self.cell.outputs)
         #     failed = True
         failed = False
-        if self.options['check'] and not unrun:
-            if not self.compare_outputs(outs, coalesce_streams(self.cell.outputs)):
+        if check:
+            if self._ref_outputs is None:
+                # The reference does not change, and coalesce_streams merges
+                # its streams in place, so only coalesce it once
+                self._ref_outputs = coalesce_streams(self.cell.outputs)
+            if not self.compare_outputs(outs, self._ref_outputs):
                 failed = True
 
         # If the comparison failed then we raise an exception.
@@ -1261,44 +1302,38 @@ class IPyNbCell(pytest.Item):
             )
 
 
-    def sanitize_outputs(self, outputs, skip_sanitize=('metadata',
-                                                       'traceback',
-                                                       'text/latex',
-                                                       'prompt_number',
-                                                       'output_type',
-                                                       'name',
-                                                       'execution_count'
-                                                       )):
+    def sanitize_outputs(self, outputs, skip_sanitize=default_skip_sanitize):
         sanitized_outputs = []
         for output in outputs:
             sanitized = {}
-            for key in output.keys():
+            for key, value in output.items():
                 if key in skip_sanitize:
-                    sanitized[key] = output[key]
+                    sanitized[key] = value
                 else:
                     if key == 'data':
-                        sanitized[key] = {}
-                        for data_key in output[key].keys():
+                        sanitized[key] = data = {}
+                        for data_key, data_value in value.items():
                             # Filter the keys in the SUB-dictionary again
                             if data_key in skip_sanitize:
-                                sanitized[key][data_key] = output[key][data_key]
+                                data[data_key] = data_value
                             else:
-                                sanitized[key][data_key] = self.sanitize(output[key][data_key])
+                                data[data_key] = self.sanitize(data_value)
 
                     # Otherwise, just create a normal dictionary entry from
                     # one of the keys of the dictionary
                     else:
                         # Create the dictionary entries on the fly, from the
                         # existing ones to be compared
-                        sanitized[key] = self.sanitize(output[key])
+                        sanitized[key] = self.sanitize(value)
             sanitized_outputs.append(nbformat.from_dict(sanitized))
         return sanitized_outputs
 
     def sanitize(self, s):
         """sanitize a string for comparison.
         """
-        
-        if not isinstance(s, str):
+        # Text in outputs is always a plain str, as loaded from JSON or
+        # kernel messages, so an exact type check suffices here
+        if type(s) is not str:
             return s
 
         """
@@ -1307,23 +1342,37 @@ class IPyNbCell(pytest.Item):
         is passed when py.test is called. Otherwise, the strings
         are not processed
         """
-        for regex, replace in self.parent.sanitize_patterns.items():
-            s = re.sub(regex, replace, s)
+        for regex, replace in self.parent.sanitize_passes:
+            s = regex.sub(replace, s)
 
-        # Remove empty lines and trailing whitespace
-        s = re.sub(r"^\s*$[\n\r]*", "", s, flags=re.MULTILINE)
-        s = re.sub(r"\s*\\*$[\n\r]*", "\n", s, flags=re.MULTILINE)
+        # Remove empty lines and trailing whitespace. On a single line
+        # without backslashes this is the same as the final strip().
+        if "\n" in s or "\\" in s:
+            s = _empty_lines_pat.sub("", s)
+            s = _trailing_whitespace_pat.sub("\n", s)
 
-        if self.parent.config.option.nbval_skip_timeit:
-            s = re.sub("TIMEIT-REPORT", "", s) #s.replace("TIMEIT-REPORT", "")
-        if self.parent.config.option.nbval_skip_memit:
-            s = re.sub("MEMIT-REPORT", "", s) #s.replace("MEMIT-REPORT", "MEMIT-REPORT")
+        for marker in self.parent.sanitize_markers:
+            s = s.replace(marker, "")
 
         return s.strip()
 
 
 carriagereturn_pat = re.compile(r'^.*\r(?=[^\n])', re.MULTILINE)
-backspace_pat = re.compile(r'[^\n]\b')
+
+
+def _apply_backspaces(text):
+    """Cancel out the character before each backspace on the same line"""
+    # Nothing before the line of the first backspace can be cancelled out,
+    # so only scan from there
+    first = text.index('\b')
+    start = max(text.rfind('\n', 0, first), text.rfind('\r', 0, first)) + 1
+    out = []
+    for ch in text[start:]:
+        if ch == '\b' and out and out[-1] not in '\n\r\b':
+            out.pop()
+        else:
+            out.append(ch)
+    return text[:start] + ''.join(out)
 
 
 def coalesce_streams(outputs):
@@ -1340,42 +1389,32 @@ def coalesce_streams(outputs):
         return outputs
 
     new_outputs = []
+    # Stream name -> (first output, texts to merge into it). The texts are
+    # joined once, as appending each to the output's text would copy all the
+    # text so far for every fragment.
     streams = {}
     for output in outputs:
-        if (output.output_type == 'stream'):
-            if output.name in streams:
-                streams[output.name].text += output.text
+        if output['output_type'] == 'stream':
+            name = output['name']
+            if name in streams:
+                streams[name][1].append(output['text'])
             else:
                 new_outputs.append(output)
-                streams[output.name] = output
+                streams[name] = (output, [output['text']])
         else:
             new_outputs.append(output)
 
     # process \r and \b characters
-    for output in streams.values():
-        old = output.text
-        while len(output.text) < len(old):
-            old = output.text
-            # Cancel out anything-but-newline followed by backspace
-            output.text = backspace_pat.sub('', output.text)
+    for output, texts in streams.values():
+        text = ''.join(texts)
+        # Cancel out anything-but-newline followed by backspace
+        if '\b' in text:
+            text = _apply_backspaces(text)
         # Replace all carriage returns not followed by newline
-        output.text = carriagereturn_pat.sub('', output.text)
-
-    return new_outputs
+        if '\r' in text:
+            text = carriagereturn_pat.sub('', text)
+        output['text'] = text
 
-
-def transform_streams_for_comparison(outputs):
-    """Makes failure output for streams better by having key be the stream name"""
-    new_outputs = []
-    for output in outputs:
-        if (output.output_type == 'stream'):
-            # Transform output
-            new_outputs.append({
-                'output_type': 'stream',
-                output.name: output.text,
-            })
-        else:
-            new_outputs.append(output)
     return new_outputs
 
 
@@ -1397,20 +1436,208 @@ def get_sanitize_patterns(string):
                       flags=re.MULTILINE)
 
 
+def compile_sanitize_patterns(patterns):
+    """
+    *Arguments*
+
+    patterns:  iterable of (regex, replace) pairs
+
+        As returned by :func:`get_sanitize_patterns`.
+
+    *Returns*
+
+    An ordered mapping of regex -> (compiled regex, replace), so that
+    each expression is only compiled once, rather than for every output
+    that is sanitized.
+    """
+    return OrderedDict(
+        (regex, (re.compile(regex), replace)) for regex, replace in patterns)
+
+
+# Per-session cache of loaded sanitize files
+_sanitize_files_key = pytest.StashKey[dict]()
+
+
+# Built-in sanitisation, see IPyNbFile.timeit_sanitiser/core_sanitizer
+_timeit_sanitize_patterns = compile_sanitize_patterns(get_sanitize_patterns("""[regex1]
+[regext1]
+regex: CPU times: .*
+replace: CPU times: CPUTIME
+
+[regext2]
+regex: Wall time: .*
+replace: Wall time: WALLTIME
+
+[regext3]
+regex: .* per loop \(mean ± std. dev. of .* runs, .* loops each\)
+replace: TIMEIT-REPORT
+"""))
+
+_core_sanitize_patterns = compile_sanitize_patterns(get_sanitize_patterns("""
+[regex1]
+regex: <graphviz.sources.Source at 0x[a-f0-9]*>
+replace: <graphviz.sources.Source>
+
+[regex2]
+regex: ^.* per loop .mean ± std. dev. of [0-9]+ runs, [0-9]+ loop each.
+replace: TIMEIT-REPORT
+
+[regex3]
+regex: peak memory: .* MiB, increment: .* MiB
+replace: MEMIT-REPORT
+
+[regex4]
+regex: <seaborn\..* at 0x[a-f0-9]*>
+replace: SEABORN-ID
+
+[regex5]
+regex: <pandas.core.groupby.generic.DataFrameGroupBy object at 0x[a-f0-9]*>
+replace: PANDAS_GROUP_BY
+
+[regex6]
+regex: <pymongo.results.InsertOneResult at 0x[a-f0-9]*>
+replace: MONGO_INSERT_ONE
+
+[regex7]
+regex: <pymongo.results.InsertManyResult at 0x[a-f0-9]*>
+replace: MONGO_INSERT_MANY
+
+[regex8]
+regex: <pymongo.cursor.Cursor at 0x[a-f0-9]*>
+replace: MONGO_CURSOR
+
+[regex9]
+regex: <pymongo.results.UpdateResult at 0x[a-f0-9]*>
+replace: MONGO_UPDATE
+
+[regex10]
+regex: <map at 0x[a-f0-9]*>
+replace: PYTHON_MAP
+
+[regex11]
+regex: <Graph identifier=.*>
+replace: RDF_GRAPH
+
+[regex12]
+regex: \s+[\n\r]+
+replace: \n
+
+[regex13]
+regex: ObjectId\('[a-f0-9]*'\)
+replace: ObjectId_
+"""))
+
+_empty_lines_pat = re.compile(r"^\s*$[\n\r]*", re.MULTILINE)
+_trailing_whitespace_pat = re.compile(r"\s*\\*$[\n\r]*", re.MULTILINE)
+
+
 def hash_string(s):
-    return hashlib.md5(s.encode("utf8")).hexdigest()
+    return hashlib.blake2b(s.encode("utf8"), digest_size=8).hexdigest()
+
+# Binary outputs, which are stored base64 encoded
+_base64_mime_types = frozenset(('image/png', 'image/jpeg'))
+
+_objectid_pat = re.compile(r"ObjectId\(([^()]*)\)")
+
+
+class _OrderedDictToDict(ast.NodeTransformer):
+    """Turn OrderedDict([(k, v), ...]) reprs into {k: v, ...} literals."""
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if (isinstance(node.func, ast.Name) and node.func.id == 'OrderedDict'
+                and not node.keywords and len(node.args) <= 1):
+            if not node.args:
+                return ast.Dict(keys=[], values=[])
+            if isinstance(node.args[0], ast.Dict):
+                # Python 3.12+ repr: OrderedDict({k: v, ...})
+                return node.args[0]
+            items = getattr(node.args[0], 'elts', None)
+            if items is not None and all(
+                    isinstance(item, ast.Tuple) and len(item.elts) == 2 for item in items):
+                return ast.Dict(keys=[item.elts[0] for item in items],
+                                values=[item.elts[1] for item in items])
+        return node
+
+
+def _literal_eval(txt):
+    """ast.literal_eval, that also reads OrderedDict reprs, as dicts."""
+    tree = ast.parse(txt.lstrip(" \t"), mode='eval')
+    return ast.literal_eval(_OrderedDictToDict().visit(tree))
+
 
 _base64 = re.compile(r'^(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?$', re.MULTILINE | re.UNICODE)
+# Any base64 string longer than 64 characters starts like this, which
+# rejects other text without copying it to strip newlines
+_base64_prefix = re.compile(r'[A-Za-z0-9+/=\n]{64}')
 
 
 def _trim_base64(s):
     """Trim and hash base64 strings"""
-    if len(s) > 64 and _base64.match(s.replace('\n', '')):
+    if (len(s) > 64 and _base64_prefix.match(s)
+            and _base64.match(s.replace('\n', ''))):
         h = hash_string(s)
-        s = '%s...<snip base64, md5=%s...>' % (s[:8], h[:16])
+        s = '%s...<snip base64, blake2b=%s...>' % (s[:8], h)
     return s
 
 
+_html_table_pat = re.compile(r'<table\b.*?</table>', re.DOTALL | re.IGNORECASE)
+_html_thead_pat = re.compile(r'<thead\b.*?</thead>', re.DOTALL | re.IGNORECASE)
+_html_row_pat = re.compile(r'<tr\b.*?</tr>', re.DOTALL | re.IGNORECASE)
+_html_cell_pat = re.compile(r'<(th|td)\b([^>]*)>(.*?)</\1\s*>', re.DOTALL | re.IGNORECASE)
+_html_colspan_pat = re.compile(r'colspan\s*=\s*["\']?(\d+)', re.IGNORECASE)
+_html_tag_pat = re.compile(r'<[^>]*>')
+
+
+def _html_row_cells(row):
+    """List the tag and text of each cell in a table row, repeated per colspan"""
+    cells = []
+    for tag, attrs, text in _html_cell_pat.findall(row):
+        colspan = _html_colspan_pat.search(attrs)
+        text = unescape(_html_tag_pat.sub('', text)).strip()
+        cells.extend([(tag.lower(), text)] * (int(colspan.group(1)) if colspan else 1))
+    return cells
+
+
+def html_table_shape(html):
+    """
+    *Arguments*
+
+    html:  str
+
+        HTML containing a table, e.g. as output for a pandas DataFrame.
+
+    *Returns*
+
+    The shape and the column names of the first table, as
+    ``(df.shape, df.columns.tolist())`` would give for the DataFrame that
+    ``pandas.read_html`` reads from it. Only the table structure is
+    scanned, which is much cheaper than building the DataFrame.
+    """
+    table = _html_table_pat.search(html)
+    table = table.group() if table else html
+    thead = _html_thead_pat.search(table)
+    if thead:
+        header_rows = [_html_row_cells(row) for row in _html_row_pat.findall(thead.group())]
+        body_rows = _html_row_pat.findall(table, thead.end())
+        ncols = max([len(row) for row in header_rows] or [0])
+    else:
+        rows = [_html_row_cells(row) for row in _html_row_pat.findall(table)]
+        if rows and rows[0] and all(tag == 'th' for tag, _ in rows[0]):
+            header_rows, body_rows = rows[:1], rows[1:]
+        else:
+            header_rows, body_rows = [], rows
+        ncols = max([len(row) for row in rows] or [0])
+    levels = [[text for _, text in row] + [''] * (ncols - len(row)) for row in header_rows]
+    if len(levels) == 1:
+        columns = [text or 'Unnamed: %d' % i for i, text in enumerate(levels[0])]
+    else:
+        columns = [
+            tuple(text or 'Unnamed: %d_level_%d' % (i, j) for j, text in enumerate(column))
+            for i, column in enumerate(zip(*levels))]
+    return (len(body_rows), ncols), columns
+
+
 def _indent(s, indent='  '):
     """Intent each line with indent"""
     if isinstance(s, str):
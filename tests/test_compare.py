@@ -0,0 +1,64 @@
+
+import os
+
+import nbformat
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_structural_output_count_mismatch(testdir):
+    # Setup notebook where the listlen test is applied to more outputs
+    # than there are in the reference
+    nb = build_nb([
+        "from IPython.display import display\n"
+        "display([1, 2])\n"
+        "[1, 2, 3]",
+    ], mark_run=True)
+    nb.cells[0].metadata['tags'] = ['nbval-test-listlen']
+    nb.cells[0].outputs.append(nbformat.v4.new_output(
+        'execute_result',
+        data={'text/plain': '[1, 2, 3]'},
+        execution_count=1,
+        ))
+
+    # Write notebook to test dir
+    nbformat.write(nb, os.path.join(
+        str(testdir.tmpdir), 'test_listlen.ipynb'))
+
+    # Run tests
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env', '.')
+
+    # The mismatch is reported, rather than failing to format the lengths
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*dissimilar number of outputs for key "text/html"*'])
+
+
+def test_dictkeys_ordereddict(testdir):
+    # OrderedDict reprs are compared on their keys, as for dicts
+    nb = build_nb([
+        "from collections import OrderedDict\n"
+        "OrderedDict([('b', 3), ('a', 4)])",
+        "OrderedDict([('a', 1), ('c', 2)])",
+    ], mark_run=True)
+    for cell in nb.cells:
+        cell.metadata['tags'] = ['nbval-test-dictkeys']
+    for i, cell in enumerate(nb.cells):
+        cell.outputs.append(nbformat.v4.new_output(
+            'execute_result',
+            data={'text/plain': "OrderedDict([('a', 1), ('b', 2)])"},
+            execution_count=i + 1,
+            ))
+
+    nbformat.write(nb, os.path.join(
+        str(testdir.tmpdir), 'test_dictkeys.ipynb'))
+
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env', '-v', '.')
+
+    # Only the cell with different keys fails
+    assert result.ret == 1
+    result.stdout.fnmatch_lines([
+        '*::Code cell 1 PASSED*',
+        '*::Code cell 2 FAILED*',
+        '*dict keys mismatch*',
+    ])
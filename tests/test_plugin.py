@@ -1,7 +1,12 @@
 import sys
 sys.path.append('..')
+import os
 import textwrap
+
+import nbformat
+
 from nbval.plugin import *
+from nbval.plugin import _trim_base64, _core_sanitize_patterns
 
 
 def test_get_sanitize_patterns():
@@ -23,3 +28,139 @@ def test_get_sanitize_patterns():
                         ('quux', '42'),
                         ('foo', 'bar2'),
                        ]
+
+
+def test_compile_sanitize_patterns():
+    patterns = compile_sanitize_patterns([('foo', 'bar1'),
+                                          ('quux', '42'),
+                                          ('foo', 'bar2'),
+                                         ])
+    # Later patterns overwrite earlier ones, but keep their position:
+    assert list(patterns.keys()) == ['foo', 'quux']
+    regex, replace = patterns['foo']
+    assert regex.pattern == 'foo'
+    assert replace == 'bar2'
+
+
+def _apply_passes(passes, s):
+    for regex, replace in passes:
+        s = regex.sub(replace, s)
+    return s
+
+
+def test_sanitize_passes_in_order():
+    file_contents = textwrap.dedent(r"""
+        regex: foo
+        replace: bar
+
+        regex: bar baz
+        replace: X
+
+        regex: 0x[0-9a-f]*
+        replace: 0xHASH
+        """)
+    patterns = compile_sanitize_patterns(get_sanitize_patterns(file_contents))
+    passes = list(patterns.values())
+    # Later patterns see what earlier ones produce
+    assert _apply_passes(passes, "foo baz") == "X"
+    assert _apply_passes(passes, "at 0x1f") == "at 0xHASH"
+
+    passes = list(_core_sanitize_patterns.values())
+    assert _apply_passes(passes, "<map at 0x1f> <Graph identifier=x>") == "PYTHON_MAP RDF_GRAPH"
+
+
+def test_find_comment_markers():
+    source = textwrap.dedent("""
+        # NBVAL_SKIP
+        a = 1  # NBVAL_CHECK_OUTPUT
+          ## NBVAL_RAISES_EXCEPTION  
+        # NBVAL_IGNORE_OUTPUT is not a marker
+        """)
+    assert list(find_comment_markers(source)) == [('skip', True),
+                                                  ('check_exception', True),
+                                                 ]
+    # Lines end where str.splitlines ends them
+    source = 'x\nNBVAL_SKIP\x0c#PYTEST_VALIDATE_IGNORE_OUTPUT'
+    assert list(find_comment_markers(source)) == [('check', False)]
+    source = '#\x0cPYTEST_VALIDATE_IGNORE_OUTPUT\r\n'
+    assert list(find_comment_markers(source)) == []
+
+
+def test_read_notebook():
+    path = os.path.join(os.path.dirname(__file__), 'sample_notebook.ipynb')
+    expected = nbformat.read(path, as_version=4)
+    nb = read_notebook(path)
+    assert nb.metadata == expected.metadata
+    assert [c.source for c in nb.cells] == [c.source for c in expected.cells]
+    assert [c.get('outputs') for c in nb.cells] == [c.get('outputs') for c in expected.cells]
+
+
+def test_read_notebook_nan(tmpdir):
+    nb = nbformat.v4.new_notebook()
+    cell = nbformat.v4.new_code_cell("{'x': float('nan')}", execution_count=1)
+    cell.outputs.append(nbformat.v4.new_output(
+        'execute_result', data={'application/json': {'x': float('nan')}},
+        execution_count=1))
+    nb.cells.append(cell)
+    path = str(tmpdir.join('nan.ipynb'))
+    nbformat.write(nb, path)
+    value = read_notebook(path).cells[0].outputs[0].data['application/json']['x']
+    assert value != value
+
+
+def test_html_table_shape():
+    # As output for pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']}, index=pd.Index(['p', 'q'], name='idx'))
+    html = textwrap.dedent("""
+        <div>
+        <table border="1" class="dataframe">
+          <thead>
+            <tr style="text-align: right;">
+              <th></th>
+              <th>a</th>
+              <th>b</th>
+            </tr>
+            <tr>
+              <th>idx</th>
+              <th></th>
+              <th></th>
+            </tr>
+          </thead>
+          <tbody>
+            <tr>
+              <th>p</th>
+              <td>1</td>
+              <td>x</td>
+            </tr>
+            <tr>
+              <th>q</th>
+              <td>2</td>
+              <td>y</td>
+            </tr>
+          </tbody>
+        </table>
+        </div>
+        """)
+    assert html_table_shape(html) == ((2, 3), [('Unnamed: 0_level_0', 'idx'),
+                                               ('a', 'Unnamed: 1_level_1'),
+                                               ('b', 'Unnamed: 2_level_1'),
+                                              ])
+
+
+def test_trim_base64():
+    data = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+    trimmed = _trim_base64(data[:40] + '\n' + data[40:])
+    assert trimmed.startswith('iVBORw0K...<snip base64, blake2b=')
+    assert _trim_base64(data[:-2] + '!!') == data[:-2] + '!!'
+    text = 'Not base64, though long enough to be checked: ' + 'x' * 40
+    assert _trim_base64(text) == text
+
+
+def test_coalesce_streams():
+    outputs = [
+        nbformat.v4.new_output('stream', name='stdout', text='abc\b\bd\n'),
+        nbformat.v4.new_output('execute_result', data={'text/plain': '1'}),
+        nbformat.v4.new_output('stream', name='stdout', text='\bx\r10%\r100%\n'),
+    ]
+    coalesced = coalesce_streams(outputs)
+    assert [o.output_type for o in coalesced] == ['stream', 'execute_result']
+    assert coalesced[0].text == 'ad\n100%\n'
@@ -0,0 +1,62 @@
+import os
+
+import nbformat
+
+from utils import build_nb
+
+
+pytest_plugins = "pytester"
+
+
+def _write_pid_nb(name, testdir, sources):
+    nb = build_nb([
+        "import os\n"
+        "with open(%r, 'w') as f:\n"
+        "    f.write(str(os.getpid()))" % (name + '.pid'),
+    ] + sources)
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), name + '.ipynb'))
+
+
+def test_reuse_kernel(testdir):
+    _write_pid_nb('nb1', testdir, ["x = 5"])
+    # The namespace should have been reset between notebooks:
+    _write_pid_nb('nb2', testdir, ["# NBVAL_RAISES_EXCEPTION\nx"])
+
+    result = testdir.inline_run('--nbval', '--nbval-current-env', '--nbval-reuse-kernel')
+    reports = [r for r in result.getreports('pytest_runtest_logreport') if r.when == 'call']
+    assert len(reports) == 4
+    assert all(r.passed for r in reports)
+
+    pids = [testdir.tmpdir.join(name + '.pid').read() for name in ('nb1', 'nb2')]
+    assert pids[0] == pids[1]
+
+
+def test_new_kernel_per_notebook(testdir):
+    _write_pid_nb('nb1', testdir, [])
+    _write_pid_nb('nb2', testdir, [])
+
+    result = testdir.inline_run('--nbval', '--nbval-current-env')
+    result.assertoutcome(passed=2)
+
+    pids = [testdir.tmpdir.join(name + '.pid').read() for name in ('nb1', 'nb2')]
+    assert pids[0] != pids[1]
+
+
+def test_reuse_kernel_reset_fails(testdir):
+    # Break %reset, as in a kernel that can not run it
+    _write_pid_nb('nb1', testdir, [
+        "x = 5\n"
+        "def reset(line):\n"
+        "    raise RuntimeError('no reset')\n"
+        "get_ipython().register_magic_function(reset)",
+    ])
+    # A fresh kernel should be started, rather than one still holding x:
+    _write_pid_nb('nb2', testdir, ["# NBVAL_RAISES_EXCEPTION\nx"])
+
+    result = testdir.inline_run('--nbval', '--nbval-current-env', '--nbval-reuse-kernel')
+    reports = [r for r in result.getreports('pytest_runtest_logreport') if r.when == 'call']
+    assert len(reports) == 4
+    assert all(r.passed for r in reports)
+
+    pids = [testdir.tmpdir.join(name + '.pid').read() for name in ('nb1', 'nb2')]
+    assert pids[0] != pids[1]
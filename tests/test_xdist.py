@@ -0,0 +1,22 @@
+import os
+
+import nbformat
+import pytest
+
+from utils import build_nb
+
+
+pytest_plugins = "pytester"
+
+
+def test_xdist_keeps_notebook_on_one_worker(testdir):
+    pytest.importorskip('xdist')
+
+    # Every cell depends on the kernel state left by the previous one:
+    for name in ('nb1', 'nb2'):
+        nb = build_nb(["a = 0"] + ["a += 1\nassert a == %d" % i for i in range(1, 10)])
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), name + '.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-reuse-kernel', '-n', '2')
+    result.assert_outcomes(passed=20)